@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+
+# Offline benchmark for vcwalker: builds a farm of git repositories (and svn
+# working copies, if svnadmin is installed) backed by file:// remotes, then
+# times discovery, the per-backend checks and the summary for several modes.
+
+import os
+import io
+import sys
+import time
+import json
+import shutil
+import logging
+import argparse
+import tempfile
+import subprocess
+import contextlib
+from vcwalker import VCWalker
+
+STATES = ['clean', 'behind', 'ahead', 'diverged', 'dirty']
+
+def run(cmd, cwd=None):
+    subprocess.check_output(cmd, cwd=cwd, stderr=subprocess.STDOUT, text=True)
+
+def commit(path, name, content):
+    with open(os.path.join(path, name), 'w') as f:
+        f.write(content)
+    run(["git", "-C", path, "add", name])
+    run(["git", "-C", path, "commit", "-q", "-m", name])
+
+def make_untracked(path, count):
+    for i in range(count):
+        d = os.path.join(path, "generated", "d%03d" % (i // 100))
+        os.makedirs(d, exist_ok=True)
+        open(os.path.join(d, "f%05d.dat" % i), 'w').close()
+
+def nested_dir(tree, index, depth):
+    # spread repositories over depth levels of plain directories
+    parts = ["level%d_%d" % (level, index % (level + 2)) for level in range(depth)]
+    return os.path.join(tree, *parts)
+
+def make_git_farm(base, args):
+    """Create args.repos clones of args.remotes bare remotes, cycling through STATES."""
+    remotes = []
+    seed = os.path.join(base, "seed")
+    for r in range(args.remotes):
+        remote = os.path.join(base, "remotes", "r%03d.git" % r)
+        run(["git", "init", "-q", "--bare", "-b", "main", remote])
+        shutil.rmtree(seed, ignore_errors=True)
+        run(["git", "clone", "-q", "file://" + remote, seed])
+        run(["git", "-C", seed, "checkout", "-q", "-b", "main"])
+        commit(seed, "one", "1")
+        commit(seed, "two", "2")
+        run(["git", "-C", seed, "push", "-q", "origin", "main"])
+        remotes.append(remote)
+    shutil.rmtree(seed, ignore_errors=True)
+
+    tree = os.path.join(base, "tree")
+    for i in range(args.repos):
+        state = args.mix[i % len(args.mix)]
+        path = os.path.join(nested_dir(tree, i, args.depth), "git%04d-%s" % (i, state))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        run(["git", "clone", "-q", "file://" + remotes[i % len(remotes)], path])
+        if state in ('behind', 'diverged'):
+            run(["git", "-C", path, "reset", "-q", "--hard", "HEAD~1"])
+        if state in ('ahead', 'diverged'):
+            commit(path, "local", "local")
+        if state == 'dirty':
+            with open(os.path.join(path, "one"), 'a') as f:
+                f.write("changed")
+            make_untracked(path, args.untracked)
+
+    # plain directories that discovery has to walk through
+    for i in range(args.filler):
+        os.makedirs(os.path.join(nested_dir(tree, i, args.depth), "filler%04d" % i, "sub"), exist_ok=True)
+    return tree
+
+def make_svn_farm(base, tree, args):
+    repo = os.path.join(base, "svnrepo")
+    url = "file://" + repo
+    run(["svnadmin", "create", repo])
+    seed = os.path.join(base, "svnseed")
+    run(["svn", "checkout", "-q", url, seed])
+    for name in ("one", "two"):
+        open(os.path.join(seed, name), 'w').write(name)
+        run(["svn", "add", "-q", os.path.join(seed, name)])
+        run(["svn", "commit", "-q", "-m", name, seed])
+    for i in range(args.svn):
+        state = ['clean', 'behind', 'dirty'][i % 3]
+        path = os.path.join(nested_dir(tree, i, args.depth), "svn%04d-%s" % (i, state))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        run(["svn", "checkout", "-q", url, path])
+        if state == 'behind':
+            run(["svn", "update", "-q", "-r", "1", path])
+        if state == 'dirty':
+            with open(os.path.join(path, "one"), 'a') as f:
+                f.write("changed")
+            make_untracked(path, args.untracked)
+
+def parse_mode(mode):
+    """Turn e.g. "j8+probe+cache" into VCWalker keyword arguments."""
+    options = {'jobs': 1}
+    for token in mode.split("+"):
+        if token.startswith("j"):
+            options['jobs'] = int(token[1:])
+        elif token == "probe":
+            options['probe_remotes'] = True
+        elif token == "cache":
+            options['status_cache'] = True
+        elif token == "fresh":
+            options['max_fetch_age'] = 3600
+        else:
+            sys.exit("Unknown mode token: %s" % token)
+    return options
+
+class TimingWalker(VCWalker):
+    """Records how long every single repository check takes, per backend."""
+
+    def _check(self, path, type):
+        start = time.perf_counter()
+        try:
+            return VCWalker._check(self, path, type)
+        finally:
+            self.durations.setdefault(type, []).append(time.perf_counter() - start)
+
+def timed(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return (time.perf_counter() - start, result)
+
+def bench_mode(tree, base, mode, repeat):
+    options = parse_mode(mode)
+    settingsfile = os.path.join(base, "settings-%s" % mode)
+    rows = []
+    for i in range(repeat):
+        walker = TimingWalker(False, False, False, False, settingsfile, False, None, rescan=(i == 0), **options)
+        walker.durations = {}
+        discovery, repositories = timed(walker.discover, tree)
+        checks, output = timed(walker.check_repositories, repositories)
+        with contextlib.redirect_stdout(io.StringIO()):
+            summary, _ = timed(walker.print_summary, output)
+        walker.shutdown()
+
+        row = {
+            'mode': mode,
+            'run': i + 1,
+            'repositories': len(repositories),
+            'discovery': discovery,
+            'checks': checks,
+            'summary': summary
+        }
+        for type, durations in walker.durations.items():
+            row['%s_mean' % type] = sum(durations) / len(durations)
+        rows.append(row)
+    return rows
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark vcwalker on a synthetic, offline repository farm.")
+    parser.add_argument('--repos', default=50, type=int, help="Number of git repositories (default: 50).")
+    parser.add_argument('--remotes', default=5, type=int, help="Number of bare remotes the repositories are cloned from (default: 5).")
+    parser.add_argument('--svn', default=0, type=int, help="Number of svn working copies (needs svnadmin, default: 0).")
+    parser.add_argument('--depth', default=2, type=int, help="Directory nesting levels above the repositories (default: 2).")
+    parser.add_argument('--filler', default=100, type=int, help="Number of plain directories without repositories (default: 100).")
+    parser.add_argument('--untracked', default=0, type=int, help="Untracked files created in every dirty repository (default: 0).")
+    parser.add_argument('--mix', default=",".join(STATES), help="Comma separated cycle of repository states (default: %s)." % ",".join(STATES))
+    parser.add_argument('--modes', default="j1,j8,j8+probe,j8+cache", help="Comma separated modes: jN for N jobs, combined with +probe, +cache, +fresh (default: j1,j8,j8+probe,j8+cache).")
+    parser.add_argument('--repeat', default=2, type=int, help="Runs per mode; the first one walks without index (default: 2).")
+    parser.add_argument('--keep', dest="keep", default=None, help="Build the farm in this directory and keep it (reused if it exists).")
+    parser.add_argument('--json', dest="json", default=None, help="Also write the results to this JSON file.")
+    args = parser.parse_args()
+    args.mix = args.mix.split(",")
+    for state in args.mix:
+        if state not in STATES:
+            sys.exit("Unknown state: %s" % state)
+
+    logging.getLogger("walker").setLevel(logging.CRITICAL)
+    for variable, value in (("GIT_AUTHOR_NAME", "bench"), ("GIT_AUTHOR_EMAIL", "bench@localhost"),
+                            ("GIT_COMMITTER_NAME", "bench"), ("GIT_COMMITTER_EMAIL", "bench@localhost")):
+        os.environ.setdefault(variable, value)
+
+    base = args.keep or tempfile.mkdtemp(prefix="vcwalker-bench-")
+    tree = os.path.join(base, "tree")
+    try:
+        if not os.path.exists(tree):
+            duration, _ = timed(make_git_farm, base, args)
+            if args.svn:
+                if shutil.which("svnadmin") == None:
+                    sys.exit("svnadmin not found, can't create svn working copies")
+                make_svn_farm(base, tree, args)
+            print("# farm created in %.1fs: %s" % (duration, base))
+
+        rows = []
+        print("%-20s %4s %6s %10s %10s %10s %10s %10s" % ("mode", "run", "repos", "discovery", "checks", "summary", "git/repo", "svn/repo"))
+        for mode in args.modes.split(","):
+            for row in bench_mode(tree, base, mode, args.repeat):
+                rows.append(row)
+                print("%-20s %4d %6d %9.3fs %9.3fs %9.4fs %10s %10s" % (row['mode'], row['run'], row['repositories'], row['discovery'], row['checks'], row['summary'],
+                      "%.4fs" % row['git_mean'] if 'git_mean' in row else "-", "%.4fs" % row['svn_mean'] if 'svn_mean' in row else "-"))
+        if args.json:
+            open(args.json, 'w').write(json.dumps(rows, indent=4, separators=(',', ': ')))
+    finally:
+        if args.keep == None:
+            shutil.rmtree(base, ignore_errors=True)
+
+if __name__ == "__main__":
+    main()
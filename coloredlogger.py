@@ -1,4 +1,9 @@
+import queue
+import atexit
 import logging
+import threading
+import contextlib
+import logging.handlers
 
 BLACK, RED, GREEN, YELLOW, BLUE, MAGENTA, CYAN, WHITE = range(8)
 
@@ -38,17 +43,80 @@ class ColoredFormatter(logging.Formatter):
             record.color = record.reset = ""
         return logging.Formatter.format(self, record)
 
-# Custom logger class with multiple destinations
-class ColoredLogger(logging.Logger):
-    FORMAT = "$BOLD%(color)s%(levelname)s$RESET: %(message)s"
-    COLOR_FORMAT = formatter_message(FORMAT, True)
-    def __init__(self, name):
-        logging.Logger.__init__(self, name, logging.DEBUG)                
+FORMAT = "$BOLD%(color)s%(levelname)s$RESET: %(message)s"
 
-        color_formatter = ColoredFormatter(self.COLOR_FORMAT)
+# Records go through a queue and are formatted and written by one listener
+# thread. Between begin and end of a block, the records of a thread are
+# collected and put on the queue together, so the output of one repository
+# is never interleaved with that of another.
+class BufferedQueueHandler(logging.handlers.QueueHandler):
+    def __init__(self, queue):
+        logging.handlers.QueueHandler.__init__(self, queue)
+        self.local = threading.local()
 
-        console = logging.StreamHandler()
-        console.setFormatter(color_formatter)
+    def prepare(self, record):
+        # no eager formatting, the listener thread does that
+        return record
 
-        self.addHandler(console)
-        return
+    def enqueue(self, record):
+        buffer = getattr(self.local, 'buffer', None)
+        if buffer != None:
+            buffer.append(record)
+        else:
+            self.queue.put_nowait([record])
+
+    @contextlib.contextmanager
+    def block(self):
+        if getattr(self.local, 'buffer', None) != None:
+            # nested block, the outer one flushes
+            yield
+            return
+        self.local.buffer = []
+        try:
+            yield
+        finally:
+            buffer = self.local.buffer
+            self.local.buffer = None
+            if buffer:
+                self.queue.put_nowait(buffer)
+
+    def wait(self):
+        """Block until everything queued so far is written."""
+        self.queue.join()
+
+class BlockQueueListener(logging.handlers.QueueListener):
+    def handle(self, records):
+        for record in records:
+            logging.handlers.QueueListener.handle(self, record)
+
+def start_logging(logger, use_color = True):
+    """Attach a BufferedQueueHandler writing colored records to stderr to logger."""
+    console = logging.StreamHandler()
+    console.setFormatter(ColoredFormatter(formatter_message(FORMAT, use_color), use_color))
+    handler = BufferedQueueHandler(queue.Queue())
+    listener = BlockQueueListener(handler.queue, console)
+    listener.start()
+    # also write the pending records on sys.exit()
+    atexit.register(listener.stop)
+    logger.addHandler(handler)
+    return handler
+
+def _buffered_handlers(logger):
+    handlers = []
+    while logger != None:
+        handlers += [h for h in logger.handlers if isinstance(h, BufferedQueueHandler)]
+        logger = logger.parent if logger.propagate else None
+    return handlers
+
+@contextlib.contextmanager
+def log_block(logger):
+    """Write the records logged by this thread inside the block together."""
+    with contextlib.ExitStack() as stack:
+        for handler in _buffered_handlers(logger):
+            stack.enter_context(handler.block())
+        yield
+
+def wait_for_log(logger):
+    """Wait until the queued records are written, e.g. before a prompt on stdout."""
+    for handler in _buffered_handlers(logger):
+        handler.wait()
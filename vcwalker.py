@@ -1,14 +1,34 @@
 #!/usr/bin/env python3
 
 import os
+import signal
 import subprocess
 import logging
-from coloredlogger import ColoredLogger
+from coloredlogger import log_block, start_logging, wait_for_log
 import argparse
 import json
+import fnmatch
+import stat
+import glob
+import hashlib
+import re
+import tempfile
+import xml.etree.ElementTree as ElementTree
+import ctypes
+import ctypes.util
+import errno
+import select
+import struct
+import enum
+import sqlite3
 import termios
 import fcntl
 import sys
+import io
+import time
+import contextlib
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 # from https://stackoverflow.com/questions/983354/how-do-i-make-python-to-wait-for-a-pressed-key
 def read_single_keypress():
@@ -56,91 +76,961 @@ def read_single_keypress():
         fcntl.fcntl(fd, fcntl.F_SETFL, flags_save)
     return ret
 
+def split_records(stream, separator=b"\0"):
+    """Yield the separator-terminated records of a binary stream as they arrive, decoded like file names."""
+    pending = b""
+    while True:
+        chunk = stream.read1(65536)
+        if not chunk:
+            break
+        records = (pending + chunk).split(separator)
+        pending = records.pop()
+        for record in records:
+            yield os.fsdecode(record)
+    if pending:
+        yield os.fsdecode(pending)
+
+class CommandTimeout(Exception):
+    """A command was killed because it ran into a timeout."""
+
+    def __init__(self, cmd, timeout):
+        Exception.__init__(self, "Timeout after %.1f seconds: %s" % (timeout, " ".join(cmd)))
+        self.cmd = cmd
+        self.timeout = timeout
+
+class DeadlineExceeded(Exception):
+    """The global deadline passed before a repository could be checked."""
+
+class PathMatcher(object):
+    """A set of paths that also understands directory prefixes and glob patterns.
+
+    Entries ending with a path separator match everything below that
+    directory, entries with glob characters (e.g. */build/*) are matched with
+    fnmatch rules; all others must match exactly. Lookups are a few hash
+    lookups plus at most one precompiled regex, however many entries there are.
+    Paths that must not be taken as patterns (e.g. app/[id].tsx) are added
+    with add_literal.
+    """
+
+    def __init__(self, patterns=()):
+        self.patterns = []
+        self.exact = set()
+        self.prefixes = set()
+        self.globs = []
+        self.regex = None
+        for pattern in patterns:
+            self.add(pattern)
+
+    def add(self, pattern):
+        if pattern in self.exact or pattern in self.prefixes or pattern in self.globs:
+            return
+        self.patterns.append(pattern)
+        if any(c in pattern for c in "*?["):
+            self.globs.append(pattern)
+            self.regex = re.compile("|".join(fnmatch.translate(x) for x in self.globs))
+        elif pattern.endswith(os.sep):
+            self.prefixes.add(pattern)
+        else:
+            self.exact.add(pattern)
+
+    @staticmethod
+    def literal(path):
+        """Return the entry that matches path itself, even if it contains glob characters."""
+        pattern = glob.escape(path)
+        if pattern != path and path.endswith(os.sep):
+            # still match everything below the directory
+            pattern += "*"
+        return pattern
+
+    def add_literal(self, path):
+        self.add(self.literal(path))
+
+    def __contains__(self, path):
+        if path in self.exact:
+            return True
+        if self.prefixes:
+            # every parent directory of path, and path itself as a directory
+            end = path.find(os.sep, 1)
+            while end != -1:
+                if path[:end + 1] in self.prefixes:
+                    return True
+                end = path.find(os.sep, end + 1)
+            if path + os.sep in self.prefixes:
+                return True
+        return self.regex != None and self.regex.match(path) != None
+
+    def __len__(self):
+        return len(self.patterns)
+
+    def __iter__(self):
+        return iter(self.patterns)
+
+class CacheDB(object):
+    """Data kept between runs in a small sqlite database, shared by all worker threads."""
+
+    def __init__(self, filename):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(filename, check_same_thread=False, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS status (path TEXT PRIMARY KEY, fingerprint TEXT, entries TEXT)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS svn_youngest (root TEXT PRIMARY KEY, revision INTEGER, time REAL)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS timings (path TEXT PRIMARY KEY, fetch REAL, status REAL)")
+
+    def get_status(self, path, fingerprint):
+        """Return the cached modified/added files of a repository, or None if its fingerprint changed."""
+        with self.lock:
+            row = self.db.execute("SELECT fingerprint, entries FROM status WHERE path = ?", (path,)).fetchone()
+        if row == None or row[0] != fingerprint:
+            return None
+        return json.loads(row[1])
+
+    def set_status(self, path, fingerprint, files):
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO status VALUES (?, ?, ?)", (path, fingerprint, json.dumps(files)))
+
+    def get_youngest(self, root, ttl):
+        """Return the youngest revision of an svn repository, if it was looked up less than ttl seconds ago."""
+        with self.lock:
+            row = self.db.execute("SELECT revision FROM svn_youngest WHERE root = ? AND time > ?", (root, time.time() - ttl)).fetchone()
+        return None if row == None else row[0]
+
+    def set_youngest(self, root, revision):
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO svn_youngest VALUES (?, ?, ?)", (root, revision, time.time()))
+
+    def get_timings(self):
+        """Return {path: (fetch, status)} with the durations of earlier checks in seconds; fetch may be None."""
+        with self.lock:
+            return {row[0]: (row[1], row[2]) for row in self.db.execute("SELECT path, fetch, status FROM timings")}
+
+    def add_timing(self, path, fetch, status):
+        """Average the durations of a check with the recorded ones; fetch is None if nothing was fetched."""
+        with self.lock:
+            row = self.db.execute("SELECT fetch, status FROM timings WHERE path = ?", (path,)).fetchone()
+            if row != None:
+                if fetch == None:
+                    fetch = row[0]
+                elif row[0] != None:
+                    fetch = (row[0] + fetch) / 2
+                status = (row[1] + status) / 2
+            self.db.execute("INSERT OR REPLACE INTO timings VALUES (?, ?, ?)", (path, fetch, status))
+
+    def decay_timings(self, paths, factor):
+        """Scale the recorded durations of paths by factor."""
+        with self.lock:
+            self.db.executemany("UPDATE timings SET fetch = fetch * ?, status = status * ? WHERE path = ?", [(factor, factor, path) for path in paths])
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+class Profiler(object):
+    """Collects wall times of commands, repository checks and walk phases."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.origin = time.perf_counter()
+        # (category, name, start, duration, thread id, args)
+        self.events = []
+
+    @contextlib.contextmanager
+    def span(self, category, name, **args):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            duration = time.perf_counter() - start
+            with self.lock:
+                self.events.append((category, name, start - self.origin, duration, threading.get_ident(), args))
+
+    def print_report(self, count, file=sys.stderr):
+        def table(title, events):
+            print("# %s" % title, file=file)
+            for duration, name in sorted(events, reverse=True)[:count]:
+                print(" %9.3fs  %s" % (duration, name), file=file)
+
+        table("Phases", [(e[3], e[1]) for e in self.events if e[0] == 'phase'])
+        table("Slowest %d repositories" % count, [(e[3], e[1]) for e in self.events if e[0] == 'repository'])
+        table("Slowest %d commands" % count, [(e[3], e[1]) for e in self.events if e[0] == 'command'])
+        totals = {}
+        for e in self.events:
+            if e[0] == 'command':
+                totals[e[5]['kind']] = totals.get(e[5]['kind'], 0) + e[3]
+        table("Total time per command", [(duration, kind) for kind, duration in totals.items()])
+
+    def write_trace(self, filename):
+        """Write the events in Chrome's trace event format (chrome://tracing, Perfetto)."""
+        pid = os.getpid()
+        events = [{
+            'name': name,
+            'cat': category,
+            'ph': 'X',
+            'ts': int(start * 1e6),
+            'dur': int(duration * 1e6),
+            'pid': pid,
+            'tid': tid,
+            'args': args
+        } for category, name, start, duration, tid, args in self.events]
+        open(filename, 'w').write(json.dumps({'traceEvents': events, 'displayTimeUnit': 'ms'}))
+
+class RepositoryFinder(object):
+    """Finds the roots of git and svn working copies below a directory.
+
+    Directories are listed with os.scandir, whose entries already know
+    whether they are directories, so only the directory itself is stat'ed
+    (for the discovery index). The index maps every directory walked so far
+    to [mtime_ns, vcs type or None, subdirectories to descend into], so that
+    directories whose mtime did not change need not be listed again.
+    """
+
+    def __init__(self, indexfile, rescan, depth, exclude, logger):
+        self.indexfile = indexfile
+        self.depth = depth
+        self.logger = logger
+        # exclude patterns with a path separator match the full path, all others the directory name
+        self.exclude_names = self._compile([x for x in exclude if not os.sep in x])
+        self.exclude_paths = self._compile([x for x in exclude if os.sep in x])
+        self.index = {}
+        self.visited = {}
+        self.walked_roots = []
+        if self.indexfile != None and os.path.exists(self.indexfile) and not rescan:
+            try:
+                self.index = json.loads(open(self.indexfile).read())['dirs']
+            except (ValueError, KeyError):
+                self.logger.warning("Ignoring corrupt discovery index %s", self.indexfile)
+
+    def _compile(self, patterns):
+        if not patterns:
+            return None
+        return re.compile("|".join(fnmatch.translate(x) for x in patterns))
+
+    def find(self, rootdir, skip_repositories):
+        """Return [(path, vcs type)] in the same (top-down) order as os.walk."""
+        return list(self.walk(rootdir, skip_repositories))
+
+    def walk(self, rootdir, skip_repositories):
+        """Like find, but yields the repositories as they are discovered."""
+        absroot = os.path.abspath(rootdir)
+        self.walked_roots.append(absroot)
+        stack = [(absroot, 1)]
+        while stack:
+            dirpath, dir_depth = stack.pop()
+            type, subdirs = self._scandir(dirpath)
+            if dirpath in skip_repositories:
+                self.logger.info("Skipping %s", dirpath)
+            elif type != None:
+                yield (dirpath, type)
+            if self.depth is not None and dir_depth > self.depth:
+                continue
+            for x in reversed(subdirs):
+                if self.exclude_names != None and self.exclude_names.match(x):
+                    continue
+                subdir = os.path.join(dirpath, x)
+                if self.exclude_paths != None and self.exclude_paths.match(subdir):
+                    continue
+                stack.append((subdir, dir_depth + 1))
+
+    def _scandir(self, dirpath):
+        """Return the vcs type of dirpath and its subdirectories to descend into.
+
+        The directory is only listed if its mtime differs from the one in the
+        discovery index.
+        """
+        try:
+            mtime = os.stat(dirpath).st_mtime_ns
+        except OSError:
+            return (None, [])
+        cached = self.index.get(dirpath)
+        if cached != None and cached[0] == mtime:
+            type, subdirs = cached[1], cached[2]
+        else:
+            names = []
+            links = set()
+            try:
+                with os.scandir(dirpath) as entries:
+                    for entry in entries:
+                        try:
+                            if entry.is_dir():
+                                names.append(entry.name)
+                                if entry.is_symlink():
+                                    links.add(entry.name)
+                        except OSError:
+                            continue
+            except OSError:
+                return (None, [])
+            if '.git' in names:
+                # note that this will cause repos to be ignored if they are sub-repos of git repos
+                type, subdirs = 'git', []
+            elif '.svn' in names:
+                # if this is the root of a svn dir, don't visit any subdirs
+                type, subdirs = 'svn', []
+            else:
+                # we are not interested in hidden directories, and like os.walk
+                # we do not follow symlinks.
+                type, subdirs = None, [x for x in names if not x.startswith('.') and x not in links]
+        self.visited[dirpath] = [mtime, type, subdirs]
+        return (type, subdirs)
+
+    def save(self):
+        if self.indexfile == None or not self.walked_roots:
+            return
+        # forget directories below the walked roots that have disappeared since
+        for dirpath in list(self.index):
+            if dirpath in self.visited:
+                continue
+            for root in self.walked_roots:
+                if dirpath == root or dirpath.startswith(root + os.sep):
+                    del self.index[dirpath]
+                    break
+        self.index.update(self.visited)
+        tmpfile = "%s.tmp" % self.indexfile
+        open(tmpfile, 'w').write(json.dumps({'dirs': self.index}))
+        os.replace(tmpfile, self.indexfile)
+
+class Inotify(object):
+    """Minimal binding of Linux' inotify through ctypes.
+
+    Raises OSError (or AttributeError, if the C library has no inotify) when
+    it can't be used.
+    """
+
+    IN_MODIFY = 0x2
+    IN_ATTRIB = 0x4
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_FROM = 0x40
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    IN_DELETE_SELF = 0x400
+    IN_Q_OVERFLOW = 0x4000
+    IN_ISDIR = 0x40000000
+    IN_NONBLOCK = 0o4000
+    IN_CLOEXEC = 0o2000000
+
+    EVENT = struct.Struct("iIII")
+
+    def __init__(self):
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self.libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self.fd = self.libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+
+    def add_watch(self, path, mask):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()), path)
+        return wd
+
+    def read(self, timeout):
+        """Wait up to timeout seconds for events, return them as [(wd, mask, name)]."""
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return []
+        events = []
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except BlockingIOError:
+                break
+            offset = 0
+            while offset < len(data):
+                wd, mask, cookie, length = self.EVENT.unpack_from(data, offset)
+                offset += self.EVENT.size
+                name = os.fsdecode(data[offset:offset + length].rstrip(b"\0"))
+                offset += length
+                events.append((wd, mask, name))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
 class VCWalker(object):
 
     auto_upgrade = False
 
-    def __init__(self, auto_update, auto_upgrade, ignore_added, interactive_add_ignore, settingsfile, launch_shell, depth):
+    def __init__(self, auto_update, auto_upgrade, ignore_added, interactive_add_ignore, settingsfile, launch_shell, depth, jobs=1, rescan=False, max_fetch_age=None, probe_remotes=False, output_format='text', command_timeout=None, repo_timeout=None, deadline=None, status_cache=False, profiler=None, max_files=None, svn_revision_ttl=None, time_budget=None):
         self.auto_upgrade = auto_upgrade
         self.auto_update = auto_update
+        # (path, vcs type, revision before, revision after, error) of every update
+        self.updates = []
         self.ignore_added = ignore_added
         self.interactive_add_ignore = interactive_add_ignore
         self.logger = logging.getLogger("walker")
-        self.noaction_files = []
+        self.noaction_files = PathMatcher()
         self.settingsfile = settingsfile
+        self.settings_lock = threading.Lock()
         self.launch_shell = launch_shell
         self.shell = os.environ.get("SHELL", "/bin/bash")
         self.depth = depth
+        self.jobs = jobs
+        self.max_fetch_age = max_fetch_age
+        # git repositories whose remote state was taken from an earlier fetch
+        self.cached_remote = set()
+        self.probe_remotes = probe_remotes
+        # git repositories whose remote-tracking refs match what the remotes advertise
+        self.probed_current = set()
+        # for the ndjson and json formats, one record is written per repository as soon as it is checked
+        self.output_format = output_format
+        self.output_lock = threading.Lock()
+        self.records_written = 0
+        # timeouts in seconds for single commands and for all commands of one
+        # repository check; deadline is an absolute time.time() for the whole run
+        self.command_timeout = command_timeout
+        self.repo_timeout = repo_timeout
+        self.deadline = deadline
+        self.local = threading.local()
+        self.profiler = profiler
+        # at most this many file names are kept (and logged) per repository and kind; counts stay exact
+        self.max_files = max_files
+        # (path, type, status, files) of repositories that need a prompt, see review()
+        self.review_queue = []
 
         if self.settingsfile != None and os.path.exists(self.settingsfile):
-            input = json.loads(open(self.settingsfile).read())
-            self.skip_files = input['skip_files']
-            self.skip_repositories = input['skip_repositories']
+            input = self._read_settings()
+            self.skip_files = PathMatcher(input['skip_files'])
+            self.skip_repositories = PathMatcher(input['skip_repositories'])
+            self.exclude = input.get('exclude', [])
         else:
-            self.skip_files = []
-            self.skip_repositories = []
+            self.skip_files = PathMatcher()
+            self.skip_repositories = PathMatcher()
+            self.exclude = []
+
+        indexfile = None if self.settingsfile == None else "%s.index" % self.settingsfile
+        self.finder = RepositoryFinder(indexfile, rescan, depth, self.exclude, self.logger)
+
+        # local status entries of repositories whose metadata did not change are reused
+        self.cache = None
+        self.status_cache = status_cache and self.settingsfile != None
+        # the youngest revision of every svn repository root is asked for once
+        # per run, and reused across runs for svn_revision_ttl seconds
+        self.svn_revision_ttl = svn_revision_ttl if self.settingsfile != None else None
+        self.svn_youngest = {}
+        self.svn_lock = threading.Lock()
+        # in watch mode, repositories are re-checked without contacting their remotes
+        self.offline = False
+        # the durations of earlier checks decide the order of the checks, and
+        # repositories expected to take longer than time_budget seconds are deferred
+        self.time_budget = time_budget
+        self.deferred = []
+        if self.settingsfile != None:
+            self.cache = CacheDB("%s.db" % self.settingsfile)
 
     def shutdown(self):
+        if self.cache != None:
+            self.cache.close()
+            self.cache = None
+        self.finder.save()
+
+    # settings files without a version hold skip lists of literal paths, from
+    # before the entries became patterns
+    SETTINGS_VERSION = 2
+
+    def _read_settings(self):
+        settings = json.loads(open(self.settingsfile).read())
+        if settings.get('version', 1) < 2:
+            for key in ('skip_files', 'skip_repositories'):
+                settings[key] = [PathMatcher.literal(x) for x in settings.get(key, [])]
+            settings['version'] = 2
+        return settings
+
+    def _remember(self, key, path):
+        """Add the literal path to the skip list key, both now and in the settings file.
+
+        The settings file is re-read and atomically replaced right away, under
+        an exclusive lock on "<settings file>.lock", so that concurrent runs
+        don't lose each other's entries and nothing is lost if this run is
+        interrupted.
+        """
+        entry = PathMatcher.literal(path)
+        getattr(self, key).add(entry)
         if self.settingsfile == None:
             return
-        output = {
-            'skip_files': self.skip_files,
-            'skip_repositories': self.skip_repositories
-        }
-        open(self.settingsfile, 'w').write(json.dumps(output, indent=4, separators=(',', ': ')))
+        with self.settings_lock, open("%s.lock" % self.settingsfile, 'w') as lockfile:
+            fcntl.flock(lockfile, fcntl.LOCK_EX)
+            settings = {'version': self.SETTINGS_VERSION, 'skip_files': [], 'skip_repositories': []}
+            if os.path.exists(self.settingsfile):
+                settings = self._read_settings()
+            if entry in settings.setdefault(key, []):
+                return
+            settings[key].append(entry)
+            fd, tmpfile = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.settingsfile)), prefix=".vcwalker-")
+            try:
+                # mkstemp creates the file with mode 0600
+                if os.path.exists(self.settingsfile):
+                    mode = stat.S_IMODE(os.stat(self.settingsfile).st_mode)
+                else:
+                    umask = os.umask(0)
+                    os.umask(umask)
+                    mode = 0o666 & ~umask
+                os.chmod(tmpfile, mode)
+                with os.fdopen(fd, 'w') as f:
+                    f.write(json.dumps(settings, indent=4, separators=(',', ': ')))
+                os.replace(tmpfile, self.settingsfile)
+            except BaseException:
+                os.unlink(tmpfile)
+                raise
 
     def walkdir(self, rootdir):
-        absroot = os.path.abspath(rootdir)
-        absrootlen = len(absroot)
+        return self.check_repositories(self.discover(rootdir))
+
+    def walkdirs(self, rootdirs):
+        """Like walkdir for several roots, which are walked in parallel."""
+        return self.check_repositories(self.discover_all(rootdirs))
+
+    def discover_all(self, rootdirs):
+        if len(rootdirs) == 1 or self.jobs == 1:
+            found = [self.discover(d) for d in rootdirs]
+        else:
+            with ThreadPoolExecutor(max_workers=min(self.jobs, len(rootdirs))) as pool:
+                found = list(pool.map(self.discover, rootdirs))
+        # overlapping roots would find the same repositories twice
+        repositories = {}
+        for root in found:
+            repositories.update((path, type) for path, type in root if not path in repositories)
+        return list(repositories.items())
+
+    WORKTREE_EVENTS = Inotify.IN_CLOSE_WRITE | Inotify.IN_CREATE | Inotify.IN_DELETE | Inotify.IN_MOVED_FROM | Inotify.IN_MOVED_TO | Inotify.IN_DELETE_SELF
+    METADATA_EVENTS = WORKTREE_EVENTS | Inotify.IN_MODIFY | Inotify.IN_ATTRIB
+
+    def watch(self, rootdirs, remote_interval, status_file, poll_interval=10):
+        """Keep checking the repositories below rootdirs until interrupted.
+
+        Repositories are re-discovered and fully checked (including their
+        remotes) every remote_interval seconds. In between, inotify reports
+        changes of working trees and vcs metadata, and only the affected
+        repositories are re-checked, locally. Without inotify, all
+        repositories are re-checked locally every poll_interval seconds.
+        After every round, the summary is written to status_file (or stdout).
+        """
+        # our own git status must not refresh the index we are watching
+        os.environ['GIT_OPTIONAL_LOCKS'] = '0'
+        try:
+            inotify = Inotify()
+        except (OSError, AttributeError) as e:
+            self.logger.warning("inotify not available (%s), polling every %d seconds.", e, poll_interval)
+            inotify = None
+        # wd -> repository path; watched repository paths
+        watches = {}
+        watched = set()
+        repositories = []
         output = {}
-        for dirpath, subdirs, files in os.walk(absroot, topdown=True):
-            if dirpath in self.skip_repositories:
-                self.logger.info("Skipping %s" % dirpath)
+        next_remote = 0
+        while True:
+            if time.time() >= next_remote:
+                repositories = self.discover_all(rootdirs)
+                self.finder.save()
+                self.updates = []
+                self.cached_remote.clear()
+                self.probed_current.clear()
+                self.svn_youngest.clear()
+                output = self.check_repositories(repositories)
+                if inotify != None:
+                    for path, type in repositories:
+                        if not path in watched:
+                            watched.add(path)
+                            self._watch_repository(inotify, watches, path, type)
+                    # don't react to what the fetches changed
+                    inotify.read(0)
+                next_remote = time.time() + remote_interval
+                self._publish(output, status_file)
                 continue
-            if '.svn' in subdirs:
-                # if this is the root of a svn dir, don't visit any subdirs
-                subdirs[:] = []
-                output[dirpath] = self.checkvc(dirpath, 'svn')
-            if '.git' in subdirs:
-                # here, it is not necessary, but we do it anyway to reduce search time
-                # note that this will cause repos to be ignored if they are sub-repos of git repos
-                subdirs[:] = []
-                output[dirpath] = self.checkvc(dirpath, 'git')
 
-            if self.depth is not None:
-                # Strip off the root directory to get depth of the current subdirectory.
-                dir_depth = len(dirpath[absrootlen:].split(os.sep))
-                if dir_depth > self.depth:
-                    subdirs[:] = []
+            timeout = max(0, next_remote - time.time())
+            if inotify == None:
+                time.sleep(min(timeout, poll_interval))
+                changed = set(path for path, type in repositories)
+            else:
+                events = inotify.read(timeout)
+                if not events:
+                    continue
+                # let bursts like a checkout or a build settle
+                time.sleep(0.2)
+                events += inotify.read(0)
+                changed = set()
+                for wd, mask, name in events:
+                    if mask & Inotify.IN_Q_OVERFLOW:
+                        changed = set(path for path, type in repositories)
+                        break
+                    if not wd in watches:
+                        continue
+                    path = watches[wd][0]
+                    changed.add(path)
+                    if mask & Inotify.IN_ISDIR and mask & (Inotify.IN_CREATE | Inotify.IN_MOVED_TO) and watches[wd][1] != None:
+                        try:
+                            self._watch_tree(inotify, watches, path, os.path.join(watches[wd][1], name))
+                        except OSError as e:
+                            # e.g. a temporary directory that is already gone again
+                            self._watch_failed(path, e)
+
+            changed = [(path, type) for path, type in repositories if path in changed]
+            if not changed:
+                continue
+            self.logger.info("Re-checking %d changed repositories.", len(changed))
+            self.offline = True
+            try:
+                result = self._check_all(changed)
+            finally:
+                self.offline = False
+            for path, type in changed:
+                if not path in result:
+                    continue
+                # the remote state is only refreshed with the next full round
+                if type == 'svn' and result[path] != None and output.get(path) and 'needs-pull' in output[path]:
+                    result[path].insert(0, 'needs-pull')
+                output[path] = result[path]
+            if inotify != None:
+                # don't react to what the checks themselves changed
+                inotify.read(0)
+            self._publish(output, status_file)
+
+    def _watch_repository(self, inotify, watches, path, type):
+        try:
+            if type == 'git':
+                gitdir = self._git_dir(path)
+                watches[inotify.add_watch(gitdir, self.METADATA_EVENTS)] = (path, None)
+                for dirpath, subdirs, files in os.walk(os.path.join(gitdir, "refs")):
+                    watches[inotify.add_watch(dirpath, self.METADATA_EVENTS)] = (path, dirpath)
+            else:
+                watches[inotify.add_watch(os.path.join(path, ".svn"), self.METADATA_EVENTS)] = (path, None)
+            self._watch_tree(inotify, watches, path, path)
+        except OSError as e:
+            self._watch_failed(path, e)
+
+    def _watch_failed(self, path, e):
+        if e.errno == errno.ENOSPC:
+            self.logger.warning("Out of inotify watches (see /proc/sys/fs/inotify/max_user_watches), not all changes of %s will be noticed.", path)
+        else:
+            self.logger.warning("Can't watch %s: %s", path, e)
+
+    def _watch_tree(self, inotify, watches, path, top):
+        for dirpath, subdirs, files in os.walk(top):
+            subdirs[:] = [x for x in subdirs if x != '.git' and x != '.svn']
+            watches[inotify.add_watch(dirpath, self.WORKTREE_EVENTS)] = (path, dirpath)
+
+    def _publish(self, output, status_file):
+        if status_file == None:
+            if self.output_format == 'text':
+                self.print_summary(output)
+                sys.stdout.flush()
+            return
+        if self.output_format == 'text':
+            summary = io.StringIO()
+            with contextlib.redirect_stdout(summary):
+                self.print_summary(output)
+            content = summary.getvalue()
+        else:
+            content = json.dumps({'time': time.time(), 'repositories': output})
+        tmpfile = "%s.tmp" % status_file
+        open(tmpfile, 'w').write(content)
+        os.replace(tmpfile, status_file)
+
+    def check_repositories(self, repositories):
+        if self.probe_remotes:
+            with self.span('phase', 'remote probe'):
+                self._git_probe_remotes([path for path, type in repositories if type == 'git'])
+        scheduled = self._schedule(repositories)
+        with self.span('phase', 'checks'):
+            output = self._check_all(scheduled)
+        # keep the order of discovery for the summary
+        output = {path: output[path] for path, type in repositories if path in output}
+        if self.auto_update:
+            with self.span('phase', 'updates'):
+                self.update_repositories(repositories, output)
+        if self.review_queue:
+            self.review(output)
+        return output
+
+    def update_repositories(self, repositories, output):
+        """Update all outdated repositories in output on the job pool, after all checks are done.
+
+        git repositories are only fast-forwarded to their already fetched
+        upstream, so no second network round trip is needed.
+        """
+        outdated = [(path, type) for path, type in repositories if output.get(path) and 'needs-pull' in output[path]]
+        if not outdated:
+            return
+        with ThreadPoolExecutor(max_workers=self.jobs) as pool:
+            results = pool.map(lambda repository: self._update(*repository), outdated)
+            for (path, type), (before, after, error) in zip(outdated, results):
+                self.updates.append((path, type, before, after, error))
+                if error == None:
+                    output[path] = [x for x in output[path] if x != 'needs-pull']
+                if self.output_format != 'text':
+                    self._write_record({
+                        'path': path,
+                        'vcs': type,
+                        'update': {'before': before, 'after': after, 'error': error}
+                    })
+
+    # factor applied to the recorded durations of a repository each time it is deferred
+    DEFERRED_DECAY = 0.75
+
+    def _schedule(self, repositories):
+        """Order repositories by their expected check duration, longest first.
+
+        The expectation comes from earlier runs; repositories that were never
+        checked go first. With a time budget, repositories expected to take
+        longer are not checked but listed in deferred. Their recorded
+        durations shrink with every deferral, so they are checked again after
+        a few runs and their estimate is renewed.
+        """
+        self.deferred = []
+        if self.cache == None:
+            return repositories
+        timings = self.cache.get_timings()
+        expected = {}
+        for path, type in repositories:
+            if path in timings:
+                fetch, status = timings[path]
+                # no fetch is expected if the remote is known to be unchanged
+                if fetch == None or self.offline or path in self.probed_current:
+                    fetch = 0
+                expected[path] = fetch + status
+        if self.time_budget != None:
+            self.deferred = [(path, type, expected[path]) for path, type in repositories if expected.get(path, 0) > self.time_budget]
+            if self.deferred:
+                self.logger.warning("Deferring %d repositories expected to take longer than %g seconds.", len(self.deferred), self.time_budget)
+                deferred = set(path for path, type, duration in self.deferred)
+                repositories = [(path, type) for path, type in repositories if not path in deferred]
+                self.cache.decay_timings(deferred, self.DEFERRED_DECAY)
+            if self.output_format != 'text':
+                for path, type, duration in self.deferred:
+                    self._write_record({'path': path, 'vcs': type, 'deferred': True, 'expected_duration': round(duration, 3)})
+        if self.jobs == 1:
+            # one by one, the order doesn't change the total time
+            return repositories
+        return sorted(repositories, key=lambda repository: -expected.get(repository[0], float('inf')))
+
+    def _update(self, path, type):
+        with log_block(self.logger):
+            if type == 'git':
+                return self._git_update(path)
+            return self._svn_update(path)
+
+    def _check_all(self, repositories):
+        output = {}
+        if self.jobs > 1:
+            pool = ThreadPoolExecutor(max_workers=self.jobs)
+            futures = {pool.submit(self._check, path, type): path for path, type in repositories}
+            try:
+                for future in as_completed(futures):
+                    try:
+                        output[futures[future]] = future.result()
+                    except DeadlineExceeded:
+                        pass
+            except BaseException:
+                # e.g. Ctrl-C: don't wait for the remaining checks
+                pool.shutdown(wait=False, cancel_futures=True)
+                raise
+            pool.shutdown()
+            # keep the order of discovery for the summary
+            output = {path: output[path] for path, type in repositories if path in output}
+        else:
+            for path, type in repositories:
+                try:
+                    output[path] = self._check(path, type)
+                except DeadlineExceeded:
+                    break
+        if len(output) < len(repositories):
+            self.logger.warning("Deadline reached, %d repositories were not checked.", len(repositories) - len(output))
+        return output
+
+    def _check(self, path, type):
+        start = time.time()
+        if self.deadline != None and start >= self.deadline:
+            raise DeadlineExceeded()
+        details = {}
+        self.local.repo = path
+        self.local.fetch_time = None
+        # the messages about one repository are written as one block
+        with log_block(self.logger), self.span('repository', path, vcs=type):
+            status = self.checkvc(path, type, details=details)
+        if self.cache != None:
+            duration = time.time() - start
+            fetch = self.local.fetch_time
+            self.cache.add_timing(path, fetch, duration - (fetch or 0))
+        if self.output_format != 'text':
+            self._write_record({
+                'path': path,
+                'vcs': type,
+                'status': status,
+                'error': details.get('error'),
+                'modified': details.get('files', {}).get('modified', []),
+                'added': details.get('files', {}).get('added', []),
+                'modified_count': details.get('files', {}).get('modified_count', 0),
+                'added_count': details.get('files', {}).get('added_count', 0),
+                'cached_remote': path in self.cached_remote,
+                'duration': round(time.time() - start, 3)
+            })
+        return status
+
+    def span(self, category, name, **args):
+        if self.profiler == None:
+            return contextlib.nullcontext()
+        return self.profiler.span(category, name, **args)
+
+    @contextlib.contextmanager
+    def _fetching(self):
+        """Count the time spent in the block as network time of the current repository check."""
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.local.fetch_time = (getattr(self.local, 'fetch_time', None) or 0) + time.time() - start
+
+    def _begin_repo(self):
+        """Start the per-repository timeout for the commands run by this thread."""
+        self.local.repo_deadline = None if self.repo_timeout == None else time.time() + self.repo_timeout
+
+    def _run(self, cmd, parse=None):
+        """Like subprocess.check_output, but honours the configured timeouts.
+
+        With parse, the output is not buffered: parse is called with the
+        binary stdout of the running command and its result is returned.
+        On a timeout the whole process group of the command (e.g. git and its
+        ssh child) is killed and CommandTimeout is raised.
+        """
+        if self.profiler == None:
+            return self._execute(cmd, parse)
+        # e.g. "git remote" or "svn status"
+        kind = " ".join([cmd[0]] + [x for x in cmd[1:] if not x.startswith("-") and not os.sep in x][:1])
+        with self.profiler.span('command', " ".join(cmd), kind=kind, repository=getattr(self.local, 'repo', None)):
+            return self._execute(cmd, parse)
 
-            # we are not interested in hidden directories.
-            subdirs[:] = [x for x in subdirs if not x.startswith('.')]
+    def _timeout(self, cmd):
+        now = time.time()
+        timeouts = [t for t in (self.command_timeout,
+                                None if getattr(self.local, 'repo_deadline', None) == None else self.local.repo_deadline - now,
+                                None if self.deadline == None else self.deadline - now) if t != None]
+        if not timeouts:
+            return None
+        timeout = min(timeouts)
+        if timeout <= 0:
+            raise CommandTimeout(cmd, 0)
+        return timeout
+
+    def _kill(self, process):
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+
+    def _execute(self, cmd, parse):
+        timeout = self._timeout(cmd)
+        if parse != None:
+            return self._execute_streaming(cmd, parse, timeout)
+        if timeout == None:
+            return subprocess.check_output(cmd, stderr=subprocess.STDOUT, text=True)
+
+        process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, start_new_session=True)
+        try:
+            output, _ = process.communicate(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            self._kill(process)
+            process.communicate()
+            raise CommandTimeout(cmd, timeout)
+        if process.returncode != 0:
+            raise subprocess.CalledProcessError(process.returncode, cmd, output=output)
         return output
 
-    def checkvc(self, path, type, try_update = True):
+    def _execute_streaming(self, cmd, parse, timeout):
+        # stderr goes to a file, so that a chatty command can't block on a full pipe
+        with tempfile.TemporaryFile() as errors:
+            process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=errors, start_new_session=timeout != None)
+            expired = threading.Event()
+            timer = None
+            if timeout != None:
+                def expire():
+                    expired.set()
+                    self._kill(process)
+                timer = threading.Timer(timeout, expire)
+                timer.start()
+            result, parse_error = None, None
+            try:
+                try:
+                    result = parse(process.stdout)
+                except Exception as e:
+                    # if the command failed, its exit status and stderr tell more
+                    parse_error = e
+                # drain whatever the parser did not consume
+                while process.stdout.read1(65536):
+                    pass
+            finally:
+                process.stdout.close()
+                process.wait()
+                if timer != None:
+                    timer.cancel()
+            if expired.is_set():
+                raise CommandTimeout(cmd, timeout)
+            if process.returncode != 0:
+                errors.seek(0)
+                raise subprocess.CalledProcessError(process.returncode, cmd, output=errors.read().decode(errors='replace'))
+            if parse_error != None:
+                raise parse_error
+            return result
+
+    def _write_record(self, record):
+        line = json.dumps(record)
+        with self.output_lock:
+            if self.output_format == 'json':
+                line = "%s  %s" % ("[\n" if self.records_written == 0 else ",\n", line)
+                sys.stdout.write(line)
+            else:
+                sys.stdout.write(line + "\n")
+            sys.stdout.flush()
+            self.records_written += 1
+
+    def finish_output(self):
+        if self.output_format == 'json':
+            sys.stdout.write("[]\n" if self.records_written == 0 else "\n]\n")
+            sys.stdout.flush()
+
+    def discover(self, rootdir):
+        with self.span('phase', 'discovery %s' % os.path.abspath(rootdir)):
+            return self.finder.find(rootdir, self.skip_repositories)
+
+    def checkvc(self, path, type, details = None):
         self.logger.info("Checking repository: %s", path)
+        try:
+            (status, files) = self._get_status(path, type)
+        except CommandTimeout as e:
+            self.logger.warning("Timeout while checking this repository: %s", path)
+            self.logger.error(str(e))
+            if details != None:
+                details['error'] = str(e)
+                details['files'] = {}
+            return ['timeout']
+
+        if details != None:
+            details['error'] = files if status == None else None
+            details['files'] = files if status != None else {}
+
+        self._log_status(path, type, status, files)
+        # prompts wait until the whole scan is done, see review()
+        if self._needs_review(type, status):
+            self.review_queue.append((path, type, status, files))
+        return status
+
+    def _get_status(self, path, type):
         if type == 'git':
-            (status, files) = self._git_get_status(path)
-        else:
-            (status, files) = self._svn_get_status(path)
+            return self._git_get_status(path)
+        return self._svn_get_status(path)
+
+    def _needs_review(self, type, status):
+        if status == None:
+            return self.interactive_add_ignore
+        if 'added' in status and self.interactive_add_ignore and type == 'git':
+            return True
+        return self.launch_shell and ('added' in status or 'needs-pull' in status or 'modified' in status or 'needs-push' in status)
 
+    def _log_status(self, path, type, status, files):
         if status == None:
-            self.logger.warning("Could not check this repository: %s" % path)
+            self.logger.warning("Could not check this repository: %s", path)
             self.logger.error(files)
-            if self.interactive_add_ignore:
-                print("What to do now? [n]o action for now, always skip this [r]epository, [q]uit, use [s]hell to investigate/fix")
-                key = read_single_keypress()
-                if key == 'r':
-                    print("Will skip repository in future runs.")
-                    self.skip_repositories.append(path)
-                elif key == 'q':
-                    self.shutdown()
-                    sys.exit("Good bye.")
-                elif key == 's':
-                    subprocess.call([self.shell], cwd=path)
-                    return self.checkvc(path, type, try_update)
-                else:
-                    print("No action.")
+            return
+        # everything below is INFO, don't walk the file lists for nothing
+        if not self.logger.isEnabledFor(logging.INFO):
             return
 
         output = False
@@ -170,7 +1060,9 @@ class VCWalker(object):
                 output = True
             self.logger.info("Locally modified files:")
             for f in files['modified']:
-                self.logger.info("  - %s" % f)
+                self.logger.info("  - %s", f)
+            if files['modified_count'] > len(files['modified']):
+                self.logger.info("  ... and %d more", files['modified_count'] - len(files['modified']))
 
         if 'added' in status:
             if not output:
@@ -178,104 +1070,389 @@ class VCWalker(object):
                 output = True
             self.logger.info("New local files:")
             for f in files['added']:
-                self.logger.info("  - %s" % f)
+                self.logger.info("  - %s", f)
+            if files['added_count'] > len(files['added']):
+                self.logger.info("  ... and %d more", files['added_count'] - len(files['added']))
 
-        if 'added' in status and self.interactive_add_ignore:
-            if type == 'git':
-                repeat = self._git_add_ignore(path, files['added'])
-                if repeat:
-                    return self.checkvc(path, type)
+    def review(self, output):
+        """Go through the repositories the scan queued for a prompt, one after another.
 
-        if 'needs-pull' in status and try_update and self.auto_update:
-            self.logger.info("Updating repository: %s", path)
-            if type == 'git':
-                self._git_update(path)
-            else:
-                self._svn_update(path)
-                return self.checkvc(path, type, False)
+        Runs after all checks (and updates) are done. Re-checks after an
+        add/ignore or a shell only redo the local status, remotes are not
+        fetched again. output is updated with the final status. The
+        deadline of the run doesn't apply here, the other timeouts do.
+        """
+        queue = self.review_queue
+        self.review_queue = []
+        if not queue:
+            return
+        # keep the order of discovery, the scan may have queued out of order
+        order = {path: i for i, path in enumerate(output)}
+        queue.sort(key=lambda item: order.get(item[0], len(order)))
+        wait_for_log(self.logger)
+        print("%d repositories to review." % len(queue))
+        deadline = self.deadline
+        self.deadline = None
+        try:
+            for i, (path, type, status, files) in enumerate(queue):
+                print("")
+                print("[%d/%d] %s" % (i + 1, len(queue), path))
+                output[path] = self._review_repository(path, type, status, files)
+        finally:
+            self.deadline = deadline
 
-        if ('added' in status or 'needs-pull' in status or 'modified' in status or 'needs-push' in status) and self.launch_shell:
-            print("Launch a shell to investigate/fix this? [y]es [n]o [q]uit")
-            key = read_single_keypress()
-            if key == 'y' or key == 'Y':
-                subprocess.call([self.shell], cwd=path)
-                return self.checkvc(path, type, try_update)
-            elif key == 'q':
-                self.shutdown()
-                sys.exit("Good bye.")
+    def _review_repository(self, path, type, status, files):
+        while True:
+            if status == None:
+                print("Could not check this repository:")
+                print(files)
+                print("What to do now? [n]o action for now, always skip this [r]epository, [q]uit, use [s]hell to investigate/fix")
+                key = read_single_keypress()
+                if key == 'r':
+                    print("Will skip repository in future runs.")
+                    self._remember('skip_repositories', path)
+                elif key == 'q':
+                    self.shutdown()
+                    sys.exit("Good bye.")
+                elif key == 's':
+                    subprocess.call([self.shell], cwd=path)
+                    (status, files) = self._recheck(path, type, status)
+                    continue
+                else:
+                    print("No action.")
+                return status
 
+            if status == ['timeout']:
+                return status
 
-        return status
+            if 'added' in status and self.interactive_add_ignore and type == 'git':
+                if self._git_add_ignore(path, files['added']):
+                    (status, files) = self._recheck(path, type, status)
+                    continue
+
+            if ('added' in status or 'needs-pull' in status or 'modified' in status or 'needs-push' in status) and self.launch_shell:
+                print("Launch a shell to investigate/fix this? [y]es [n]o [q]uit")
+                key = read_single_keypress()
+                if key == 'y' or key == 'Y':
+                    subprocess.call([self.shell], cwd=path)
+                    (status, files) = self._recheck(path, type, status)
+                    continue
+                elif key == 'q':
+                    self.shutdown()
+                    sys.exit("Good bye.")
+            return status
+
+    def _recheck(self, path, type, previous):
+        """Redo the local status of path only, without contacting its remote."""
+        self.logger.info("Re-checking repository: %s", path)
+        self.offline = True
+        try:
+            (status, files) = self._get_status(path, type)
+        except CommandTimeout as e:
+            self.logger.error(str(e))
+            return (['timeout'], str(e))
+        finally:
+            self.offline = False
+        # svn only knows about new revisions from the server, keep what the scan found
+        if type == 'svn' and status != None and previous and 'needs-pull' in previous and not 'needs-pull' in status:
+            status.insert(0, 'needs-pull')
+        self._log_status(path, type, status, files)
+        wait_for_log(self.logger)
+        return (status, files)
 
     def _git_get_status(self, path):
+        self._begin_repo()
         out_status = []
-        out_files = {
+
+        if self._git_fetch_needed(path):
+            try:
+                with self._fetching():
+                    self._run(["git", "-C", path, "remote", "update"])
+            except subprocess.CalledProcessError as e:
+                self.logger.error(e.output)
+                return (None, e.output)
+
+        out_files = None
+        if self.status_cache:
+            out_files = self.cache.get_status(path, self._git_fingerprint(path))
+
+        if out_files != None:
+            # nothing changed locally, so only redo the comparison with the upstream
+            try:
+                counts = self._run(["git", "-C", path, "rev-list", "--left-right", "--count", "@...@{u}"])
+            except subprocess.CalledProcessError as e:
+                self.logger.error(e.output)
+                return (None, e.output)
+            ahead, behind = [int(x) for x in counts.split()]
+        else:
+            # A single status call reports both the ahead/behind counts against the
+            # upstream (in the "# branch.*" headers) and the local modifications.
+            try:
+                (ahead_behind, message, out_files) = self._run(["git", "-C", path, "status", "--porcelain=v2", "--branch", "-z"],
+                                                               lambda stream: self._git_parse_status(path, split_records(stream)))
+            except subprocess.CalledProcessError as e:
+                self.logger.error(e.output)
+                return (None, e.output)
+
+            if self.status_cache:
+                # git status may have refreshed the index, so take the fingerprint afterwards
+                self.cache.set_status(path, self._git_fingerprint(path), out_files)
+            if ahead_behind == None:
+                self.logger.error(message)
+                return (None, message)
+            ahead, behind = ahead_behind
+
+        self._drop_noaction_files(out_files)
+        if out_files['modified_count']:
+            out_status.append("modified")
+        if out_files['added_count']:
+            out_status.append("added")
+
+        if ahead and behind:
+            out_status.insert(0, "diverged")
+        elif behind:
+            out_status.insert(0, "needs-pull")
+        elif ahead:
+            out_status.insert(0, "needs-push")
+
+        return (out_status, out_files)
+
+    def _new_files(self):
+        return {
             'modified': [],
-            'added': []
+            'added': [],
+            'modified_count': 0,
+            'added_count': 0
         }
 
-        try:
-            subprocess.check_output(["git", "-C", path, "remote", "update"], stderr=subprocess.STDOUT, text=True)
-        except subprocess.CalledProcessError as e:
-            self.logger.error(e.output)
-            return (None, e.output)
+    def _add_file(self, files, kind, file):
+        """Count a modified or added file, keeping at most max_files names of each kind."""
+        if file in self.skip_files or (kind == 'added' and self.ignore_added):
+            return
+        files[kind + '_count'] += 1
+        if self.max_files == None or len(files[kind]) < self.max_files:
+            files[kind].append(file)
+
+    def _drop_noaction_files(self, files):
+        # noaction files were chosen from the listed names during this run, so
+        # they are filtered here rather than when parsing (or in the cache)
+        if not self.noaction_files:
+            return
+        for kind in ('modified', 'added'):
+            kept = [f for f in files[kind] if not f in self.noaction_files]
+            files[kind + '_count'] -= len(files[kind]) - len(kept)
+            files[kind] = kept
+
+    def _git_parse_status(self, path, records):
+        """Parse the records of git status --porcelain=v2 --branch -z.
+
+        Returns ((ahead, behind), error message, files), where files is a dict
+        as built by _add_file. (ahead, behind) is None if there is no upstream
+        to compare with.
+        """
+        branch = None
+        upstream = None
+        ahead_behind = None
+        files = self._new_files()
+        debug = self.logger.isEnabledFor(logging.DEBUG)
+        for record in records:
+            if debug:
+                self.logger.debug("Checking: >>%s<<", record)
+            if record.startswith("# branch.head "):
+                branch = record[14:]
+                continue
+            if record.startswith("# branch.upstream "):
+                upstream = record[18:]
+                continue
+            if record.startswith("# branch.ab "):
+                ahead, behind = record[12:].split(" ")
+                ahead_behind = (int(ahead[1:]), int(behind[1:]))
+                continue
+            if record.startswith("#"):
+                continue
 
-        # Use the strategy described in https://stackoverflow.com/questions/3258243/git-check-if-pull-needed to check if a pull is needed
+            if record[0] == '1':
+                xy, name = record[2:4], record.split(" ", 8)[8]
+            elif record[0] == '2':
+                xy, name = record[2:4], record.split(" ", 9)[9]
+                # renames and copies are followed by the original path
+                next(records)
+            elif record[0] == 'u':
+                xy, name = record[2:4], record.split(" ", 10)[10]
+            elif record[0] == '?':
+                xy, name = '??', record[2:]
+            else:
+                continue
+
+            if xy[1] in 'MARCD':
+                self._add_file(files, 'modified', os.path.join(path, name))
+            elif xy == '??':
+                self._add_file(files, 'added', os.path.join(path, name))
+
+        message = None
+        if ahead_behind == None:
+            # no upstream (or a detached HEAD): there is nothing to compare with
+            if branch == None or branch == "(detached)":
+                message = "fatal: HEAD does not point to a branch"
+            elif upstream != None:
+                message = "fatal: upstream branch '%s' of branch '%s' does not exist" % (upstream, branch)
+            else:
+                message = "fatal: no upstream configured for branch '%s'" % branch
+        return (ahead_behind, message, files)
+
+    def _git_fingerprint(self, path):
+        # Metadata that changes with commits, checkouts, staging and ignore
+        # rules, plus the root directory entries. Edits inside tracked files
+        # and new or removed files in subdirectories don't touch any of
+        # these, which is why the cache is opt-in.
+        gitdir = self._git_dir(path)
+        files = [path, os.path.join(path, ".gitignore")]
+        files += [os.path.join(gitdir, x) for x in ("index", "HEAD", "packed-refs", os.path.join("info", "exclude"))]
         try:
-            local = subprocess.check_output(["git", "-C", path, "rev-parse", "@"], stderr=subprocess.STDOUT, text=True)
-        except subprocess.CalledProcessError as e:
-            self.logger.error(e.output)
-            return (None, e.output)
+            head = open(os.path.join(gitdir, "HEAD")).read().strip()
+            if head.startswith("ref: "):
+                files.append(os.path.join(gitdir, head[5:]))
+        except OSError:
+            pass
+        return self._fingerprint(files)
 
+    def _fingerprint(self, files):
+        # the cached file lists depend on these settings, too
+        parts = [hashlib.sha1(json.dumps([self.skip_files.patterns, self.ignore_added, self.max_files]).encode()).hexdigest()]
+        for f in files:
+            try:
+                st = os.stat(f)
+                parts.append("%d:%d" % (st.st_mtime_ns, st.st_size))
+            except OSError:
+                parts.append("-")
+        return " ".join(parts)
+
+    def _git_fetch_needed(self, path):
+        if self.offline or path in self.probed_current:
+            return False
+        if self.max_fetch_age == None:
+            return True
+        # FETCH_HEAD is rewritten by every fetch, whoever ran it
         try:
-            remote = subprocess.check_output(["git", "-C", path, "rev-parse", "@{u}"], stderr=subprocess.STDOUT, text=True)
-        except subprocess.CalledProcessError as e:
-            self.logger.error(e.output)
-            return (None, e.output)
+            age = time.time() - os.stat(os.path.join(self._git_dir(path), "FETCH_HEAD")).st_mtime
+        except OSError:
+            return True
+        if age > self.max_fetch_age:
+            return True
+        self.logger.debug("Last fetch %d seconds ago, using cached remote state: %s", age, path)
+        self.cached_remote.add(path)
+        return False
+
+    def _git_probe_remotes(self, paths):
+        """Find git repositories whose upstreams did not move since their last fetch.
 
+        Every unique remote URL is asked for its branch heads once, with
+        git ls-remote. A repository whose remote-tracking refs already match
+        all advertised heads of all its remotes is added to probed_current
+        and will not be fetched.
+        """
+        pool = ThreadPoolExecutor(max_workers=self.jobs)
+        candidates = [path for path in paths if self._git_fetch_needed(path)]
+        remotes = dict(zip(candidates, pool.map(self._git_remotes, candidates)))
+        urls = set(url for repo_remotes in remotes.values() if repo_remotes != None for url in repo_remotes[0].values())
+        heads = dict(zip(urls, pool.map(self._git_ls_remote, urls)))
+        pool.shutdown()
+
+        for path, repo_remotes in remotes.items():
+            if repo_remotes == None:
+                continue
+            urls_by_name, tracking = repo_remotes
+            current = True
+            for name, url in urls_by_name.items():
+                if heads[url] == None:
+                    current = False
+                    break
+                for ref, sha in heads[url].items():
+                    if tracking.get("refs/remotes/%s/%s" % (name, ref[11:])) != sha:
+                        current = False
+                        break
+                if not current:
+                    break
+            if current:
+                self.logger.debug("Remote branches unchanged, skipping fetch: %s", path)
+                self.probed_current.add(path)
+        self.logger.info("Probed %d remote URLs, %d of %d git repositories need a fetch.", len(urls), len(candidates) - len(self.probed_current), len(candidates))
+
+    def _git_remotes(self, path):
+        """Return ({remote name: url}, {remote-tracking ref: sha}) for a repository.
+
+        Returns None if the repository has no remotes or a remote uses a
+        non-standard fetch refspec, since its refs can't be compared then.
+        """
+        self._begin_repo()
         try:
-            base = subprocess.check_output(["git", "-C", path, "merge-base", "@", "@{u}"], stderr=subprocess.STDOUT, text=True)
+            config = self._run(["git", "-C", path, "config", "--get-regexp", r"^remote\."])
+            refs = self._run(["git", "-C", path, "for-each-ref", "--format=%(objectname) %(refname)", "refs/remotes"])
         except subprocess.CalledProcessError as e:
-            self.logger.error(e.output)
-            return (None, e.output)
+            self.logger.debug(e.output)
+            return None
+        except CommandTimeout as e:
+            self.logger.debug(str(e))
+            return None
 
-        if local == remote:
-            pass
-        elif local == base:
-            out_status.append("needs-pull")
-        elif remote == base:
-            out_status.append("needs-push")
-        else:
-            out_status.append("diverged")
+        urls = {}
+        fetch = {}
+        for line in config.split("\n")[:-1]:
+            key, value = line.split(" ", 1)
+            name, setting = key[7:].rsplit(".", 1)
+            if setting == 'url':
+                if not ':' in value and not os.path.isabs(value):
+                    # relative paths are relative to the repository
+                    value = os.path.normpath(os.path.join(path, value))
+                urls[name] = value
+            elif setting == 'fetch':
+                fetch.setdefault(name, []).append(value)
+        if not urls:
+            return None
+        for name in urls:
+            if fetch.get(name) != ["+refs/heads/*:refs/remotes/%s/*" % name]:
+                return None
+
+        tracking = dict(reversed(line.split(" ", 1)) for line in refs.split("\n")[:-1])
+        return (urls, tracking)
 
-        # Now check for local modifications
+    def _git_ls_remote(self, url):
+        self._begin_repo()
         try:
-            status = subprocess.check_output(["git", "-C", path, "status", "--porcelain"], stderr=subprocess.STDOUT, text=True)
+            output = self._run(["git", "ls-remote", "--heads", url])
         except subprocess.CalledProcessError as e:
-            self.logger.error(e.output)
-            return (None, e.output)
-
-        for line in status.split("\n")[:-1]:
-            self.logger.debug("Checking: >>%s<<" % line)
-            file = os.path.join(path, line[3:])
-            if file in self.noaction_files or file in self.skip_files:
-                continue
-            if line[1] in 'MARCD':
-                if not 'modified' in out_status:
-                    out_status.append("modified")
-                out_files['modified'].append(file)
-            if line[0:2] == '??' and not self.ignore_added:
-                if not 'added' in out_status:
-                    out_status.append("added")
-                out_files['added'].append(file)
+            # the fetch will report the error
+            self.logger.debug(e.output)
+            return None
+        except CommandTimeout as e:
+            self.logger.debug(str(e))
+            return None
+        return dict(reversed(line.split("\t", 1)) for line in output.split("\n")[:-1])
 
-        return (out_status, out_files)
+    def _git_dir(self, path):
+        gitdir = os.path.join(path, ".git")
+        if os.path.isfile(gitdir):
+            # worktrees and submodules have a .git file pointing to the real directory
+            content = open(gitdir).read().strip()
+            if content.startswith("gitdir: "):
+                gitdir = os.path.join(path, content[8:])
+        return gitdir
 
     def _git_update(self, path):
+        """Fast-forward to the fetched upstream. Returns (commit before, commit after, error)."""
+        self._begin_repo()
+        self.logger.info("Updating repository: %s", path)
+        before = None
         try:
-            subprocess.check_output(["git", "-C", path, "pull"], stderr=subprocess.STDOUT, text=True)
+            before = self._run(["git", "-C", path, "rev-parse", "HEAD"]).strip()
+            self._run(["git", "-C", path, "merge", "--ff-only", "--quiet", "@{u}"])
+            return (before, self._run(["git", "-C", path, "rev-parse", "HEAD"]).strip(), None)
         except subprocess.CalledProcessError as e:
             self.logger.error(e.output)
+            return (before, None, e.output.strip())
+        except CommandTimeout as e:
+            self.logger.error(str(e))
+            return (before, None, str(e))
 
     # return True to indicate that the repo should be re-read
     def _git_add_ignore(self, path, files):
@@ -308,10 +1485,10 @@ class VCWalker(object):
                 self._git_add_to_ignore_file(path, ignore, True)
                 return True
             elif key == 'k':
-                self.skip_files.append(f)
+                self._remember('skip_files', f)
                 print("Will skip file in future runs.")
             elif key == 'r':
-                self.skip_repositories.append(path)
+                self._remember('skip_repositories', path)
                 print("Will skip repository in future runs.")
                 return False
             elif key == 's':
@@ -325,7 +1502,7 @@ class VCWalker(object):
                 sys.exit("Good bye.")
             else:
                 print("Doing nothing...")
-                self.noaction_files.append(f)
+                self.noaction_files.add_literal(f)
         return False
 
     def _git_prepare_ignore(self, path, what):
@@ -359,17 +1536,41 @@ class VCWalker(object):
                 self.logger.error(e.output)
 
     def _svn_get_status(self, path):
+        self._begin_repo()
         out_status = []
-        out_files = {
-            'modified': [],
-            'added': []
-        }
+        out_files = None
+        if self.status_cache:
+            fingerprint = self._svn_fingerprint(path)
+            out_files = self.cache.get_status(path, fingerprint)
+        cached = out_files != None
+
         try:
-            status = subprocess.check_output(["svn", "status", "-u", path], stderr=subprocess.STDOUT, text=True)
+            # if the whole working copy is at the youngest revision of its
+            # repository, there can't be anything to update
+            current = self.offline
+            if not current:
+                with self._fetching():
+                    current = self._svn_is_current(path)
+            if cached:
+                # nothing changed locally, so only ask the server for new revisions
+                needs_update = False
+                if not current:
+                    with self._fetching():
+                        needs_update = self._svn_needs_update(path)
+            elif current:
+                (needs_update, out_files) = self._run(["svn", "status", "--xml", path], self._svn_parse_status)
+            else:
+                # mostly waiting for the server
+                with self._fetching():
+                    (needs_update, out_files) = self._run(["svn", "status", "--xml", "-u", path], self._svn_parse_status)
+        except (ElementTree.ParseError, ValueError) as e:
+            # e.g. output of an svn version this parser does not know
+            self.logger.error("Can't read the svn status of %s: %s", path, e)
+            return (None, "Can't read svn status: %s" % e)
         except subprocess.CalledProcessError as e:
             if 'E155036' in e.output:
                 if self.auto_upgrade:
-                    self.logger.warn("Upgrading SVN version.")
+                    self.logger.warning("Upgrading SVN version.")
                     if self._svn_upgrade(path):
                         return self._svn_get_status(path)
                 self.logger.error("SVN version is too old.")
@@ -378,58 +1579,251 @@ class VCWalker(object):
                 self.logger.error(e.output)
                 return (None, e.output)
 
-        self.logger.debug("Status: %s" % status)
-        for line in status.split('\n')[:-1]:
-            self.logger.debug("Checking: >>%s<<" % line)
-            if line[0] in 'ACDMR!':
-                if not 'modified' in out_status:
-                    out_status.append("modified")
-                out_files['modified'].append(line[21:])
-
-            elif line[0] == '?' and not self.ignore_added:
-                if not 'added' in out_status:
-                    out_status.append("added")
-                out_files['added'].append(line[21:])
+        if self.status_cache and not cached:
+            self.cache.set_status(path, fingerprint, out_files)
 
-            if line[8] == '*':
-                if not "needs-pull" in out_status:
-                    out_status.append("needs-pull")
+        self._drop_noaction_files(out_files)
+        if needs_update:
+            out_status.append("needs-pull")
+        if out_files['modified_count']:
+            out_status.append("modified")
+        if out_files['added_count']:
+            out_status.append("added")
 
         return (out_status, out_files)
 
+    def _svn_parse_status(self, stream):
+        """Parse svn status --xml as it arrives. Returns (needs update, files)."""
+        files = self._new_files()
+        needs_update = False
+        debug = self.logger.isEnabledFor(logging.DEBUG)
+        # the open elements; entries are in <target> or, for changelists, in <changelist>
+        parents = []
+        for event, element in ElementTree.iterparse(stream, events=('start', 'end')):
+            if event == 'start':
+                parents.append(element)
+                continue
+            parents.pop()
+            if element.tag != 'entry':
+                continue
+            wc_status = element.find('wc-status')
+            item = 'none' if wc_status is None else wc_status.get('item')
+            repos_status = element.find('repos-status')
+            if debug:
+                self.logger.debug("Checking: >>%s %s<<", item, element.get('path'))
+            # the same items that svn status shows as A, C, D, M, R or ! in the first column
+            if item in ('added', 'conflicted', 'deleted', 'modified', 'replaced', 'missing'):
+                self._add_file(files, 'modified', element.get('path'))
+            elif item == 'unversioned':
+                self._add_file(files, 'added', element.get('path'))
+            # out of date, like the * in the eighth column of svn status -u
+            if repos_status is not None and (repos_status.get('item', 'none') != 'none' or repos_status.get('props', 'none') != 'none'):
+                needs_update = True
+            # don't keep the parsed entries around
+            if parents:
+                parents[-1].remove(element)
+        return (needs_update, files)
+
+    def _svn_fingerprint(self, path):
+        # svn status does not write to wc.db, so unlike git it can be taken up front
+        return self._fingerprint([path, os.path.join(path, ".svn", "wc.db")])
+
+    def _svn_needs_update(self, path):
+        local = self._run(["svn", "info", "--show-item", "last-changed-revision", path])
+        remote = self._run(["svn", "info", "-r", "HEAD", "--show-item", "last-changed-revision", path])
+        return int(remote) > int(local)
+
+    def _svn_is_current(self, path):
+        """Whether every item of the working copy is at the youngest revision of its repository."""
+        # svnversion prints e.g. 4168, 4123:4168M or 4168S; the first number is the lowest revision
+        version = re.match(r"(\d+)", self._run(["svnversion", "-n", path]))
+        if version == None:
+            return False
+        root = self._run(["svn", "info", "--show-item", "repos-root-url", path]).strip()
+        youngest = self._svn_youngest(root)
+        self.logger.debug("Working copy at r%s, youngest revision of %s is r%d", version.group(1), root, youngest)
+        return int(version.group(1)) >= youngest
+
+    def _svn_youngest(self, root):
+        with self.svn_lock:
+            if not root in self.svn_youngest:
+                self.svn_youngest[root] = [threading.Lock(), None]
+            entry = self.svn_youngest[root]
+        # only the first working copy of a repository asks, the others wait for it
+        with entry[0]:
+            if entry[1] == None and self.svn_revision_ttl != None:
+                entry[1] = self.cache.get_youngest(root, self.svn_revision_ttl)
+            if entry[1] == None:
+                entry[1] = int(self._run(["svn", "info", "--show-item", "revision", root]))
+                if self.svn_revision_ttl != None:
+                    self.cache.set_youngest(root, entry[1])
+            return entry[1]
+
     def _svn_upgrade(self, path):
         try:
-            status = subprocess.check_output(["svn", "upgrade", path], stderr=subprocess.STDOUT, text=True)
+            status = self._run(["svn", "upgrade", path])
         except subprocess.CalledProcessError as e:
-            logger.error(e.output)
+            self.logger.error(e.output)
+            return False
+        except CommandTimeout as e:
+            self.logger.error(str(e))
             return False
         return True
 
     def _svn_update(self, path):
+        """Returns (revision before, revision after, error)."""
+        self._begin_repo()
+        self.logger.info("Updating repository: %s", path)
+        before = None
         try:
-            status = subprocess.check_output(["svn", "update", path], stderr=subprocess.STDOUT, text=True)
+            before = self._run(["svn", "info", "--show-item", "revision", path]).strip()
+            self._run(["svn", "update", "--non-interactive", path])
+            return (before, self._run(["svn", "info", "--show-item", "revision", path]).strip(), None)
         except subprocess.CalledProcessError as e:
-            logger.error(e.output)
+            self.logger.error(e.output)
+            return (before, None, e.output.strip())
+        except CommandTimeout as e:
+            self.logger.error(str(e))
+            return (before, None, str(e))
 
     def print_summary(self, result):
-        print("# <-- remote changes; --> local changes; |--| diverged; M modified files; A added files; E error.")
+        # don't mix the summary with log messages still in the queue
+        wait_for_log(self.logger)
+        print("# <-- remote changes; --> local changes; |--| diverged; M modified files; A added files; E error; T timeout; * cached remote state.")
         for path, result in list(result.items()):
             if result == []:
                 continue
             if result == None:
                 a, b, c, d = " ", "E", "E", " "
+            elif "timeout" in result:
+                a, b, c, d = " ", "T", "T", " "
             else:
                 a = "|" if "diverged" in result else ("<" if "needs-pull" in result else " ")
                 b = "M" if "modified" in result else "-"
                 c = "A" if "added" in result else "-"
                 d = "|" if "diverged" in result else (">" if "needs-push" in result else " ")
 
-            print(" %s%s%s%s  %s" % (a, b, c, d, path))
+            e = "*" if path in self.cached_remote else " "
+
+            print(" %s%s%s%s%s %s" % (a, b, c, d, e, path))
+        if self.updates:
+            print("# Updates:")
+            for path, type, before, after, error in self.updates:
+                if type == 'git':
+                    before, after = (before or "?")[:10], (after or "?")[:10]
+                else:
+                    before, after = "r%s" % before, "r%s" % after
+                if error == None:
+                    print(" %s..%s  %s" % (before, after, path))
+                else:
+                    print(" failed  %s: %s" % (path, error.split("\n")[-1]))
+        if self.deferred:
+            print("# Deferred, expected to take longer than %g seconds:" % self.time_budget)
+            for path, type, duration in self.deferred:
+                print(" %7.2fs  %s" % (duration, path))
+        if self.cached_remote:
+            print("# %d repositories answered from cached remote state (fetched less than %d seconds ago)." % (len(self.cached_remote), self.max_fetch_age))
+
+# Library interface: no prompts, no output, no settings file.
+
+class Status(enum.Flag):
+    CLEAN = 0
+    NEEDS_PULL = enum.auto()
+    NEEDS_PUSH = enum.auto()
+    DIVERGED = enum.auto()
+    MODIFIED = enum.auto()
+    ADDED = enum.auto()
+    ERROR = enum.auto()
+    TIMEOUT = enum.auto()
+
+STATUS_FLAGS = {
+    'needs-pull': Status.NEEDS_PULL,
+    'needs-push': Status.NEEDS_PUSH,
+    'diverged': Status.DIVERGED,
+    'modified': Status.MODIFIED,
+    'added': Status.ADDED,
+    'timeout': Status.TIMEOUT
+}
+
+class RepositoryStatus(object):
+    """The result of check_repository."""
+
+    __slots__ = ('path', 'vcs', 'flags', 'modified', 'added', 'modified_count', 'added_count', 'error', 'duration')
+
+    def __init__(self, path, vcs, flags, modified, added, modified_count, added_count, error, duration):
+        self.path = path
+        self.vcs = vcs
+        self.flags = flags
+        self.modified = modified
+        self.added = added
+        self.modified_count = modified_count
+        self.added_count = added_count
+        self.error = error
+        self.duration = duration
+
+    def __repr__(self):
+        return "RepositoryStatus(%r, %r, %s, modified=%d, added=%d)" % (self.path, self.vcs, self.flags, self.modified_count, self.added_count)
+
+api_logger = logging.getLogger("walker.api")
+api_logger.addHandler(logging.NullHandler())
+
+def find_repositories(paths, depth=None, exclude=(), skip=(), index_file=None):
+    """Yield (path, vcs type) for every git/svn working copy below paths, as it is found.
+
+    exclude holds glob patterns of directories not to descend into, skip the
+    paths or patterns of repositories to leave out. With index_file, the
+    discovery index is used and updated once the generator is exhausted.
+    """
+    if isinstance(paths, str):
+        paths = [paths]
+    finder = RepositoryFinder(index_file, False, depth, list(exclude), api_logger)
+    skip = PathMatcher(skip)
+    for path in paths:
+        yield from finder.walk(path, skip)
+    finder.save()
+
+def check_repository(path, vcs=None, fetch=True, ignore_added=False, skip_files=(), max_files=None, timeout=None):
+    """Check a single repository and return a RepositoryStatus.
+
+    Without fetch, git remotes are not contacted (svn asks its server for
+    new revisions only if fetch is set). timeout limits all commands of
+    the check together, in seconds.
+    """
+    path = os.path.abspath(path)
+    if vcs == None:
+        if os.path.exists(os.path.join(path, ".git")):
+            vcs = 'git'
+        elif os.path.isdir(os.path.join(path, ".svn")):
+            vcs = 'svn'
+        else:
+            raise ValueError("Not a git or svn working copy: %s" % path)
+    walker = VCWalker(False, False, ignore_added, False, None, False, None, repo_timeout=timeout, max_files=max_files)
+    walker.logger = api_logger
+    walker.skip_files = PathMatcher(skip_files)
+    walker.offline = not fetch
+
+    start = time.time()
+    try:
+        if vcs == 'git':
+            (status, files) = walker._git_get_status(path)
+        else:
+            (status, files) = walker._svn_get_status(path)
+    except CommandTimeout as e:
+        (status, files) = (['timeout'], str(e))
+    duration = time.time() - start
+
+    if status == None or status == ['timeout']:
+        flags = Status.ERROR if status == None else Status.TIMEOUT
+        return RepositoryStatus(path, vcs, flags, [], [], 0, 0, files, duration)
+    flags = Status.CLEAN
+    for x in status:
+        flags |= STATUS_FLAGS[x]
+    return RepositoryStatus(path, vcs, flags, files['modified'], files['added'], files['modified_count'], files['added_count'], None, duration)
 
 if __name__ == "__main__":
 
     parser = argparse.ArgumentParser(description = "Recursively find GIT and SVN repositories in a given path and check if remote or local files need updates.")
-    parser.add_argument('--update', '-u', dest="auto_update", action="store_true", help="Perform a git pull or svn update if a repository is found to be outdated.")
+    parser.add_argument('--update', '-u', dest="auto_update", action="store_true", help="After checking, fast-forward git repositories to their fetched upstream and svn update outdated working copies (in parallel with --jobs).")
     parser.add_argument('--upgrade', dest="auto_upgrade", action="store_true", help="Perform a svn upgrade if necessary (outdated SVN data format version in repository).")
     parser.add_argument('--ignore-added', '-n', dest="ignore_added", action="store_true", help="Ignore files added in the local file system.")
     parser.add_argument('--verbose', '-v', dest="verbose", default=0, action="count", help="Output all messages about single repositories. Use twice for debug output.")
@@ -438,12 +1832,29 @@ if __name__ == "__main__":
     parser.add_argument('--interactive', '-i', dest="interactive", action="store_true", help="Ask for adding/ignoring new files.")
     parser.add_argument('--depth', '-d', dest="depth", default=None, type=int, help="Maximum directory depth.")
     parser.add_argument('--shell', '-s', dest="shell", action="store_true", help="Launch a shell in every directory that has modified/added files (implies -v).")
+    parser.add_argument('--rescan', dest="rescan", action="store_true", help="Ignore the discovery index and walk all directories again.")
+    parser.add_argument('--max-fetch-age', dest="max_fetch_age", default=None, type=int, metavar="SECONDS", help="Don't fetch git repositories that were fetched less than SECONDS ago.")
+    parser.add_argument('--probe-remotes', dest="probe_remotes", action="store_true", help="Ask every remote URL for its branches once (git ls-remote) and only fetch git repositories whose upstream moved.")
+    parser.add_argument('--format', dest="output_format", default="text", choices=["text", "ndjson", "json"], help="Write one record per repository to stdout as soon as it is checked, as JSON lines (ndjson) or a JSON array (json), instead of the text summary.")
+    parser.add_argument('--command-timeout', dest="command_timeout", default=None, type=float, metavar="SECONDS", help="Kill single git/svn commands that take longer than SECONDS.")
+    parser.add_argument('--repo-timeout', dest="repo_timeout", default=None, type=float, metavar="SECONDS", help="Give up on a repository if checking (or updating) it takes longer than SECONDS.")
+    parser.add_argument('--time-budget', dest="time_budget", default=None, type=float, metavar="SECONDS", help="Don't check repositories whose checks took longer than SECONDS in earlier runs, list them instead.")
+    parser.add_argument('--deadline', dest="deadline", default=None, type=float, metavar="SECONDS", help="Stop after SECONDS and report the repositories checked so far.")
+    parser.add_argument('--status-cache', dest="status_cache", action="store_true", help="Reuse the local status of repositories whose index, HEAD/refs and top directory did not change since the last run. Misses edits inside tracked files and files added or removed below the top directory.")
+    parser.add_argument('--profile', dest="profile", action="store_true", help="Time every command, repository and phase, and print the slowest to stderr.")
+    parser.add_argument('--profile-top', dest="profile_top", default=10, type=int, metavar="N", help="With --profile, how many of the slowest entries to print (default: 10).")
+    parser.add_argument('--trace', dest="trace", default=None, metavar="FILE", help="Write the profile as Chrome trace events to FILE (implies --profile).")
+    parser.add_argument('--svn-revision-ttl', dest="svn_revision_ttl", default=None, type=float, metavar="SECONDS", help="Reuse the youngest revision of svn repositories looked up in earlier runs for SECONDS.")
+    parser.add_argument('--watch', dest="watch", action="store_true", help="Keep running: re-check repositories as soon as their files change (using inotify) and their remotes every --remote-interval seconds.")
+    parser.add_argument('--remote-interval', dest="remote_interval", default=300, type=float, metavar="SECONDS", help="In watch mode, how often to re-discover repositories and check their remotes (default: 300).")
+    parser.add_argument('--status-file', dest="status_file", default=None, metavar="FILE", help="In watch mode, keep the current summary in FILE (JSON with --format json/ndjson) instead of printing it.")
+    parser.add_argument('--max-files', dest="max_files", default=None, type=int, metavar="N", help="List at most N modified and N added files per repository (the counts are always exact).")
+    parser.add_argument('--jobs', '-j', dest="jobs", default=1, type=int, help="Number of repositories to check in parallel (default: 1).")
     parser.add_argument('--settings-file', '-f', dest="settingsfile", default="~/.config/vcwalker", help="An alternate settings file (default: ~/.config/vcwalker).")
     parser.add_argument('path', nargs="*", default=["."], help="Paths to search for repositories (Default: Working Directory).")
     args = parser.parse_args()
 
-    if not args.no_color:
-        logging.setLoggerClass(ColoredLogger)
+    start_logging(logging.getLogger('walker'), not args.no_color)
 
     if args.shell:
         args.verbose = max(args.verbose, 1)
@@ -458,12 +1869,52 @@ if __name__ == "__main__":
         print("Error: depth cannot be negative")
         exit(1)
 
-    walker = VCWalker(args.auto_update, args.auto_upgrade, args.ignore_added, args.interactive, os.path.expanduser(args.settingsfile), args.shell, args.depth)
+    if args.watch and (args.interactive or args.shell):
+        print("Error: --watch can't be combined with --interactive or --shell")
+        exit(1)
+
+    if args.watch and args.output_format == "json" and args.status_file is None:
+        # an endless stream of records can't be one JSON array
+        print("Error: --watch with --format json needs --status-file, use --format ndjson to stream records")
+        exit(1)
 
-    result = {}
-    for d in args.path:
-        result.update(walker.walkdir(d))
+    if args.watch and args.deadline is not None:
+        print("Error: --deadline can't be combined with --watch, use --repo-timeout or --command-timeout")
+        exit(1)
 
-    if args.summary:
-        walker.print_summary(result)
+    if args.output_format != "text" and (args.interactive or args.shell):
+        print("Error: --interactive and --shell need the text output format")
+        exit(1)
+
+    if args.jobs < 1:
+        print("Error: jobs must be at least 1")
+        exit(1)
+
+    deadline = None if args.deadline is None else time.time() + args.deadline
+
+    if args.trace is not None:
+        args.profile = True
+    profiler = Profiler() if args.profile else None
+
+    walker = VCWalker(args.auto_update, args.auto_upgrade, args.ignore_added, args.interactive, os.path.expanduser(args.settingsfile), args.shell, args.depth, args.jobs, args.rescan, args.max_fetch_age, args.probe_remotes, args.output_format, args.command_timeout, args.repo_timeout, deadline, args.status_cache, profiler, args.max_files, args.svn_revision_ttl, args.time_budget)
+
+    if args.watch:
+        try:
+            walker.watch(args.path, args.remote_interval, args.status_file)
+        except KeyboardInterrupt:
+            pass
+        walker.shutdown()
+        exit(0)
+
+    result = walker.walkdirs(args.path)
+
+    walker.finish_output()
+    if args.summary and args.output_format == "text":
+        with walker.span('phase', 'summary'):
+            walker.print_summary(result)
     walker.shutdown()
+
+    if profiler is not None:
+        profiler.print_report(args.profile_top)
+        if args.trace is not None:
+            profiler.write_trace(args.trace)